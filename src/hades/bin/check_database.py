@@ -26,6 +26,16 @@ from hades.config import load_config
 
 logger = logging.getLogger('hades.bin.check_database')
 
+#: Tables the agent user must be able to access
+AGENT_TABLES = (db.radacct, db.radpostauth)
+#: Tables the portal user must be able to access
+PORTAL_TABLES = (db.radacct, db.radpostauth, db.radusergroup)
+#: Tables the RADIUS user must be able to access
+RADIUS_TABLES = (
+    db.radacct, db.radgroupcheck, db.radgroupreply, db.radpostauth,
+    db.radreply, db.radusergroup,
+)
+
 
 def check_database(
         engine: Engine,
@@ -41,24 +51,29 @@ def check_database(
     """
     logger.info("Checking database access as user %s", user.pw_name)
     try:
+        # Nothing is written, so don't spend round trips on BEGIN and
+        # ROLLBACK
         conn = engine.connect()
     except DBAPIError as e:
         logger.critical("Could not connect to database as %s: %s",
                         user.pw_name, exc_info=e)
         raise
     with contextlib.closing(conn):
-        for table in tables:
-            try:
-                check_table(conn, table)
-            except DBAPIError as e:
-                logger.critical("Query check for table %s as user %s failed: "
-                                "%s", table.name, user.pw_name, exc_info=e)
-                raise
+        try:
+            check_tables(conn, tables)
+        except DBAPIError as e:
+            logger.critical("Query check for tables %s as user %s failed: "
+                            "%s", ", ".join(table.name for table in tables),
+                            user.pw_name, exc_info=e)
+            raise
 
 
-def check_table(conn: Connection, table: Table) -> None:
-    """Perform :sql:`SELECT NULL` on a given table."""
-    conn.execute(select([exists(select([null()]).select_from(table))])).scalar()
+def check_tables(conn: Connection, tables: Iterable[Table]) -> None:
+    """Perform :sql:`SELECT NULL` on a set of tables in a single query."""
+    conn.execute(select([
+        exists(select([null()]).select_from(table)).label(table.name)
+        for table in tables
+    ])).first()
 
 
 def create_parser() -> ArgumentParser:
@@ -76,17 +91,13 @@ def main() -> int:
         engine = db.create_engine(config, poolclass=NullPool)
         agent_pwd: pwd.struct_passwd = pwd.getpwnam(constants.AGENT_USER)
         with dropped_privileges(agent_pwd):
-            check_database(engine, agent_pwd,
-                           (db.radacct, db.radpostauth))
+            check_database(engine, agent_pwd, AGENT_TABLES)
         portal_pwd: pwd.struct_passwd = pwd.getpwnam(constants.PORTAL_USER)
         with dropped_privileges(portal_pwd):
-            check_database(engine, portal_pwd,
-                           (db.radacct, db.radpostauth, db.radusergroup))
+            check_database(engine, portal_pwd, PORTAL_TABLES)
         radius_pwd: pwd.struct_passwd = pwd.getpwnam(constants.RADIUS_USER)
         with dropped_privileges(radius_pwd):
-            check_database(engine, radius_pwd,
-                           (db.radacct, db.radgroupcheck, db.radgroupreply,
-                            db.radpostauth, db.radreply, db.radusergroup))
+            check_database(engine, radius_pwd, RADIUS_TABLES)
     except DBAPIError:
         return os.EX_TEMPFAIL
     return os.EX_OK
@@ -1,24 +1,31 @@
+"""dnsmasq ``--dhcp-script`` that stores DHCP leases in the Hades database.
+
+Every lease event touches at most the single row of its IP address, which is
+the primary key of the lease tables: ``add`` and ``old`` use a single
+:sql:`INSERT … ON CONFLICT DO UPDATE` and ``del`` a single :sql:`DELETE`.
+These statements are atomic on their own, so :sql:`READ COMMITTED` isolation
+suffices.
+"""
 from __future__ import annotations
 import argparse
-import codecs
-import grp
+import functools
 import itertools
 import logging
 import os
 import pwd
 import typing
 from argparse import _SubParsersAction
-from contextlib import closing
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Any, Callable, Dict, Iterable, Optional, Tuple, TypeVar, TextIO, \
     Mapping
 
 import netaddr
-import sqlalchemy
-from sqlalchemy import text, Table
+from sqlalchemy import bindparam, Table, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine.base import Connection, Engine
-from sqlalchemy.engine.result import RowProxy
+from sqlalchemy.sql.expression import Delete, Insert
+from sqlalchemy.util import LRUCache
 
 from hades import constants
 from hades.common.cli import ArgumentParser, common_parser, setup_cli_logging
@@ -32,13 +39,37 @@ from hades.config import load_config
 
 logger = logging.getLogger(__name__)
 
+#: Cache of the compiled forms of the per-lease statements, which are
+#: executed for every DHCP lease event
+compiled_cache = LRUCache(64)
+
+#: Statement marking the ``init`` dump transaction as read-only
+SET_TRANSACTION_READ_ONLY = text("SET TRANSACTION READ ONLY")
+
+#: Lease columns that are ``NOT NULL`` and default to an empty array. All other
+#: optional lease columns default to ``NULL``.
+EMPTY_ARRAY_COLUMNS = ("Tags", "RequestedOptions", "UserClasses")
+
 
 def engine_from_config(filename: str) -> Engine:
     config = load_config(filename)
-    engine = create_engine(config, isolation_level="SERIALIZABLE")
+    engine = create_engine(config, isolation_level="READ COMMITTED")
     return engine
 
 
+def format_mac_unix(mac: int) -> bytes:
+    """Format a 48-bit MAC address as colon-separated lowercase hex bytes,
+    i.e. like :class:`netaddr.mac_unix_expanded`."""
+    return b"%02x:%02x:%02x:%02x:%02x:%02x" % (
+        (mac >> 40) & 0xff,
+        (mac >> 32) & 0xff,
+        (mac >> 24) & 0xff,
+        (mac >> 16) & 0xff,
+        (mac >> 8) & 0xff,
+        mac & 0xff,
+    )
+
+
 def generate_leasefile_lines(
     leases: Iterable[
         Tuple[
@@ -49,34 +80,40 @@ def generate_leasefile_lines(
             Optional[bytes],
         ]
     ]
-) -> typing.Iterator[str]:
+) -> typing.Iterator[bytes]:
     """
     Generate lines in dnsmasq leasefile format from an iterable.
 
     :param leases: An iterable that yields (ExpiresAt, MAC, IPAddress,
         Hostname, ClientID)-tuples
-    :return: An iterable of strings
+    :return: An iterable of encoded lines
     """
     for expires_at, mac, ip, hostname, raw_client_id in leases:
-        mac = netaddr.EUI(mac)
-        mac.dialect = netaddr.mac_unix_expanded
-
-        client_id: str
-        if raw_client_id is None:
-            client_id = "*"
-        else:
-            it = iter(raw_client_id.hex())
-            client_id = ":".join(a + b for a, b in zip(it, it))
-
-        yield "{expires_at:d} {mac} {ip} {hostname} {client_id}\n".format(
-            expires_at=int(expires_at.timestamp()),
-            mac=mac,
-            ip=ip,
-            hostname=hostname if hostname is not None else "*",
-            client_id=client_id,
+        yield b"%d %b %b %b %b\n" % (
+            int(expires_at.timestamp()),
+            format_mac_unix(int(mac)),
+            str(ip).encode("ascii"),
+            hostname.encode("utf-8") if hostname is not None else b"*",
+            (
+                raw_client_id.hex(":").encode("ascii")
+                if raw_client_id is not None else b"*"
+            ),
         )
 
 
+#: Size of the chunks in which the leasefile is written to stdout
+LEASEFILE_CHUNK_SIZE = 512 * 1024
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """Write all of `data` to the file descriptor `fd`, retrying on short
+    writes."""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
 # noinspection PyUnusedLocal
 def print_leases(
     args: typing.Any,
@@ -84,9 +121,30 @@ def print_leases(
     engine: Engine,
 ) -> int:
     """Print all leases in dnsmasq leasefile format"""
+    # Bypass the text layer and write larger chunks directly to the fd
+    stdout = context.stdout
+    stdout.flush()
+    fd = stdout.fileno()
+    chunk = bytearray()
+    # The transaction is required for the server-side cursor
     with engine.connect() as connection, connection.begin():
-        leases = get_all_dhcp_leases(context.dhcp_lease_table, connection)
-    context.stdout.writelines(generate_leasefile_lines(leases))
+        # The single SELECT already sees one consistent snapshot under READ
+        # COMMITTED, so a stricter isolation level would not buy anything.
+        # Declare the transaction read-only instead.
+        connection.execute(SET_TRANSACTION_READ_ONLY)
+        # Fetch the leases in batches using a server-side cursor, so that the
+        # memory usage does not grow with the number of leases
+        leases = get_all_dhcp_leases(
+            context.dhcp_lease_table,
+            connection.execution_options(stream_results=True),
+        )
+        for line in generate_leasefile_lines(leases):
+            chunk += line
+            if len(chunk) >= LEASEFILE_CHUNK_SIZE:
+                write_all(fd, chunk)
+                chunk.clear()
+    if chunk:
+        write_all(fd, chunk)
     return os.EX_OK
 
 
@@ -102,10 +160,14 @@ def get_env_safe(environ: Mapping[str, str], name: str) -> Optional[str]:
     :param name:
     :return:
     """
-    value = environ.get(name, None)
-    if value is not None:
-        value = value.encode("utf-8", "backslashreplace").decode("utf-8")
-    return value
+    value = environ.get(name)
+    if value is None:
+        return None
+    # Undecodable bytes are represented as lone surrogates, which can't occur
+    # in ASCII strings
+    if value.isascii():
+        return value
+    return value.encode("utf-8", "backslashreplace").decode("utf-8")
 
 
 T = TypeVar("T")
@@ -134,7 +196,11 @@ def obtain_and_convert(
 
 
 def obtain_user_classes(environ: Mapping[str, str]) -> typing.Iterator[str]:
-    """Gather all user classes from environment variables."""
+    """Gather all user classes from environment variables.
+
+    dnsmasq numbers the user classes consecutively starting at zero, so
+    probing stops at the first missing variable.
+    """
     for number in itertools.count():
         user_class = get_env_safe(environ, "DNSMASQ_USER_CLASS" + str(number))
         if user_class is None:
@@ -154,7 +220,7 @@ def obtain_tuple(
         return None
 
     try:
-        tup = tuple(func(v) for v in value.split(sep) if v)
+        tup = tuple([func(v) for v in value.split(sep) if v])
     except ValueError as e:
         raise ValueError(
             f"Environment variable {name} contains illegal value {value}"
@@ -162,19 +228,29 @@ def obtain_tuple(
     return typing.cast(Tuple[T], tup)
 
 
-@dataclass
-class LeaseArguments:
+class LeaseArguments(typing.Protocol):
+    """The positional arguments of the lease commands.
+
+    The namespaces produced by the lease command parsers have these
+    attributes and are passed as is instead of being converted.
+    """
     mac: netaddr.EUI
     ip: netaddr.IPAddress
     hostname: Optional[str]
 
-    @classmethod
-    def from_anonymous_args(cls, args: typing.Any) -> LeaseArguments:
-        return cls(
-            mac=args.mac,
-            ip=args.ip,
-            hostname=args.hostname,
-        )
+
+#: Lease columns taken verbatim from (sanitized) string environment variables
+STRING_ENV_COLUMNS = (
+    ("SuppliedHostname", "DNSMASQ_SUPPLIED_HOSTNAME"),
+    ("Domain", "DNSMASQ_DOMAIN"),
+    ("VendorClass", "DNSMASQ_VENDOR_CLASS"),
+)
+#: Lease columns taken verbatim from binary environment variables
+BINARY_ENV_COLUMNS = (
+    ("CircuitID", b"DNSMASQ_CIRCUIT_ID"),
+    ("SubscriberID", b"DNSMASQ_SUBSCRIBER_ID"),
+    ("RemoteID", b"DNSMASQ_REMOTE_ID"),
+)
 
 
 def obtain_lease_info(
@@ -194,26 +270,29 @@ def obtain_lease_info(
     environment variable should result in the corresponding key being present
     with value of None in the resulting dict or if the key should be absent.
     """
-    expires_at_int = obtain_and_convert(context.environ, "DNSMASQ_LEASE_EXPIRES", int)
-    time_remaining = obtain_and_convert(context.environ, "DNSMASQ_TIME_REMAINING", int)
+    environ = context.environ
+    environb = context.environb
+    expires_at_int = obtain_and_convert(environ, "DNSMASQ_LEASE_EXPIRES", int)
+    time_remaining = obtain_and_convert(environ, "DNSMASQ_TIME_REMAINING", int)
     if time_remaining is None:
         time_remaining = 0
     if expires_at_int is None:
-        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        now = datetime.now(timezone.utc)
         expires_at = now + timedelta(seconds=time_remaining)
     else:
-        expires_at = datetime.utcfromtimestamp(expires_at_int).replace(
-            tzinfo=timezone.utc
-        )
+        expires_at = datetime.fromtimestamp(expires_at_int, timezone.utc)
 
-    client_id = context.environb.get(b"DNSMASQ_CLIENT_ID")
-    if client_id is not None:
+    raw_client_id = environb.get(b"DNSMASQ_CLIENT_ID")
+    client_id: Optional[bytes] = None
+    if raw_client_id is not None:
         try:
-            client_id = codecs.decode(client_id.replace(b":", b""), "hex")
+            client_id = bytes.fromhex(
+                raw_client_id.replace(b":", b"").decode("ascii")
+            )
         except ValueError as e:
             raise ValueError(
-                "Environment variable DNSMASQ_CLIENT_ID contains "
-                f"illegal value {context.environ.get('DNSMASQ_CLIENT_ID')}"
+                "Environment variable DNSMASQ_CLIENT_ID contains illegal value "
+                f"{raw_client_id.decode('utf-8', 'backslashreplace')}"
             ) from e
 
     values = {
@@ -223,82 +302,80 @@ def obtain_lease_info(
         "ExpiresAt": expires_at,
     }
 
-    def set_value(key: str, value: typing.Any) -> None:
-        if value is not None or missing_as_none:
-            values[key] = value
-
     hostname = args.hostname
-    if hostname is not None or "DNSMASQ_OLD_HOSTNAME" in context.environ:
+    if hostname is not None or "DNSMASQ_OLD_HOSTNAME" in environ:
         values["Hostname"] = hostname
 
-    set_value(
-        "SuppliedHostname", get_env_safe(context.environ, "DNSMASQ_SUPPLIED_HOSTNAME")
-    )
-    set_value("Tags", obtain_tuple(context.environ, "DNSMASQ_TAGS", " "))
-    set_value("Domain", get_env_safe(context.environ, "DNSMASQ_DOMAIN"))
-    set_value("CircuitID", context.environb.get(b"DNSMASQ_CIRCUIT_ID"))
-    set_value("SubscriberID", context.environb.get(b"DNSMASQ_SUBSCRIBER_ID"))
-    set_value("RemoteID", context.environb.get(b"DNSMASQ_REMOTE_ID"))
-    set_value("VendorClass", get_env_safe(context.environ, "DNSMASQ_VENDOR_CLASS"))
-
-    user_classes = tuple(obtain_user_classes(context.environ))
-    user_classes = user_classes if user_classes != () else None
-    set_value("UserClasses", user_classes)
-    set_value(
-        "RelayIPAddress",
-        obtain_and_convert(context.environ, "DNSMASQ_RELAY_ADDRESS", netaddr.IPAddress),
-    )
-    set_value(
-        "RequestedOptions",
-        obtain_tuple(context.environ, "DNSMASQ_REQUESTED_OPTIONS", ",", int),
+    user_classes = tuple(obtain_user_classes(environ))
+    optional_values = (
+        *((key, get_env_safe(environ, name)) for key, name in STRING_ENV_COLUMNS),
+        *((key, environb.get(name)) for key, name in BINARY_ENV_COLUMNS),
+        ("Tags", obtain_tuple(environ, "DNSMASQ_TAGS", " ")),
+        ("UserClasses", user_classes if user_classes != () else None),
+        (
+            "RelayIPAddress",
+            obtain_and_convert(
+                environ, "DNSMASQ_RELAY_ADDRESS", netaddr.IPAddress
+            ),
+        ),
+        (
+            "RequestedOptions",
+            obtain_tuple(environ, "DNSMASQ_REQUESTED_OPTIONS", ",", int),
+        ),
     )
+    for key, value in optional_values:
+        if value is not None or missing_as_none:
+            values[key] = value
 
     return values
 
 
-def query_lease_for_update(
-    connection: Connection,
+@functools.lru_cache(maxsize=None)
+def delete_lease_query(dhcp_lease_table: Table) -> Delete:
+    """Build a :sql:`DELETE` statement for the lease of the IP address bound to
+    the ``ip`` parameter."""
+    return dhcp_lease_table.delete().where(
+        dhcp_lease_table.c.IPAddress == bindparam("ip")
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def upsert_lease_query(
     dhcp_lease_table: Table,
-    ip: netaddr.IPAddress,
-) -> Optional[RowProxy]:
-    query = dhcp_lease_table.select(
-        dhcp_lease_table.c.IPAddress == ip
-    ).with_for_update()
-    with closing(connection.execute(query)) as result:
-        row = result.fetchone()
-        if result.fetchone() is not None:
-            logger.warning(
-                "Querying database for lease with IP %s "
-                "returned more than one row",
-                ip,
-            )
-        return row
+    columns: typing.FrozenSet[str],
+) -> Insert:
+    """Build an :sql:`INSERT … ON CONFLICT DO UPDATE` statement for a lease
+    with the given columns.
 
+    The values are bound as parameters named like the columns, so that the
+    statement can be reused for all leases with the same set of columns.
+    """
+    insert = postgresql.insert(dhcp_lease_table)
+    excluded = insert.excluded
+    changes = {k: excluded[k] for k in columns if k != "IPAddress"}
+    changes["UpdatedAt"] = excluded.UpdatedAt
+    return insert.on_conflict_do_update(
+        index_elements=[dhcp_lease_table.c.IPAddress],
+        set_=changes,
+    )
 
-def perform_lease_update(
+
+def upsert_lease(
     connection: Connection,
     dhcp_lease_table: Table,
-    ip: netaddr.IPAddress,
-    mac: netaddr.EUI,
-    old: RowProxy,
-    new: Dict[str, Any],
-) -> typing.Optional[sqlalchemy.engine.Result]:
-    changes = {k: v for k, v in new.items() if old[k] != v}
-    if not changes:
-        return None
-    query = dhcp_lease_table.update(values=changes).where(
-        dhcp_lease_table.c.IPAddress == ip
-    )
-    result = connection.execute(query)
-    if result.rowcount != 1:
-        logger.warning(
-            "Unexpected row count %d while updating lease for IP %s "
-            "and MAC %s",
-            result.rowcount,
-            ip,
-            mac,
-        )
-    return result
+    values: Dict[str, Any],
+) -> None:
+    """Insert a lease or update the existing lease of the same IP address with
+    a single :sql:`INSERT … ON CONFLICT DO UPDATE` statement.
+
+    :param connection: A SQLAlchemy connection
+    :param dhcp_lease_table: DHCP lease table
+    :param values: The column values of the lease
+    """
+    query = upsert_lease_query(dhcp_lease_table, frozenset(values))
+    connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(query, values)
 
 
 def add_lease(
@@ -307,12 +384,13 @@ def add_lease(
     engine: Engine,
 ) -> int:
     values = obtain_lease_info(
-        LeaseArguments.from_anonymous_args(args),
+        args,
         context,
         missing_as_none=True
     )
-    values = {k: (v if v is not None else text('DEFAULT'))
-              for k, v in values.items()}
+    for k in EMPTY_ARRAY_COLUMNS:
+        if values[k] is None:
+            values[k] = ()
     ip, mac = values["IPAddress"], values["MAC"]
     logger.debug(
         "Inserting new lease for IP %s and MAC %s",
@@ -320,14 +398,7 @@ def add_lease(
         mac,
     )
     with engine.connect() as connection, connection.begin():
-        lease_table = context.dhcp_lease_table
-        # TODO: Use INSERT ON CONFLICT UPDATE on newer SQLAlchemy (>= 1.1)
-        old_values = query_lease_for_update(connection, lease_table, ip)
-        if old_values is None:
-            connection.execute(lease_table.insert(values=values))
-        else:
-            logger.warning("Lease for IP %s and MAC %s already exists", ip, mac)
-            perform_lease_update(connection, lease_table, ip, mac, old_values, values)
+        upsert_lease(connection, context.dhcp_lease_table, values)
     return os.EX_OK
 
 
@@ -337,16 +408,17 @@ def delete_lease(
     engine: Engine,
 ) -> int:
     values = obtain_lease_info(
-        LeaseArguments.from_anonymous_args(args),
+        args,
         context,
         missing_as_none=False
     )
     ip, mac = values["IPAddress"], values["MAC"]
     logger.debug("Deleting lease for IP %s and MAC %s", ip, mac)
-    lease_table = context.dhcp_lease_table
-    query = lease_table.delete().where(lease_table.c.IPAddress == ip)
+    query = delete_lease_query(context.dhcp_lease_table)
     with engine.connect() as connection, connection.begin():
-        result = connection.execute(query)
+        result = connection.execution_options(
+            compiled_cache=compiled_cache
+        ).execute(query, ip=ip)
     if result.rowcount != 1:
         logger.warning(
             "Unexpected row count %d while deleting lease for IP %s and MAC %s",
@@ -363,21 +435,14 @@ def update_lease(
     engine: Engine,
 ) -> int:
     values = obtain_lease_info(
-        LeaseArguments.from_anonymous_args(args),
+        args,
         context,
         missing_as_none=False
     )
-    values.setdefault('UpdatedAt', text('DEFAULT'))
     ip, mac = values["IPAddress"], values["MAC"]
     logger.debug("Updating lease for IP %s and MAC %s", ip, mac)
     with engine.connect() as connection, connection.begin():
-        # TODO: Use INSERT ON CONFLICT UPDATE on newer SQLAlchemy (>= 1.1)
-        lease_table = context.dhcp_lease_table
-        old_values = query_lease_for_update(connection, lease_table, ip)
-        if old_values is None:
-            connection.execute(lease_table.insert(values=values))
-        else:
-            perform_lease_update(connection, lease_table, ip, mac, old_values, values)
+        upsert_lease(connection, context.dhcp_lease_table, values)
     return os.EX_OK
 
 
@@ -452,9 +517,52 @@ def create_parser(standalone: bool = True) -> ArgumentParser:
     return parser
 
 
-@dataclass
+#: Commands that take the MAC, IP and optionally hostname arguments
+LEASE_COMMANDS = frozenset(("add", "del", "old"))
+
+
+def parse_lease_command(
+    args: typing.Sequence[str],
+) -> typing.Optional[argparse.Namespace]:
+    """Parse the common invocations of dnsmasq without argparse.
+
+    dnsmasq calls the script for every lease event with a fixed argument
+    layout, so the ``init``, ``add``, ``del`` and ``old`` commands can be
+    parsed directly. Anything else, including options and invalid
+    addresses, is left to the parser created by :func:`create_parser`, so
+    that it is handled and reported the same way as before.
+
+    :param args: The arguments without the program name
+    :return: The same namespace the parser would produce, or None if the
+        arguments must be parsed by the parser.
+    """
+    if not args or any(arg.startswith("-") for arg in args):
+        return None
+    command = args[0]
+    if command == "init" and len(args) == 1:
+        return argparse.Namespace(command=command, original_command=command)
+    if command not in LEASE_COMMANDS or not 3 <= len(args) <= 4:
+        return None
+    try:
+        mac = netaddr.EUI(args[1])
+        ip = netaddr.IPAddress(args[2])
+    except (netaddr.AddrFormatError, TypeError, ValueError):
+        return None
+    return argparse.Namespace(
+        command=command,
+        original_command=command,
+        mac=mac,
+        ip=ip,
+        hostname=args[3] if len(args) == 4 else None,
+    )
+
+
+@dataclass(frozen=True)
 class Context:
     """Information relevant to the communication of the program"""
+    __slots__ = (
+        "stdin", "stdout", "stderr", "environ", "environb", "dhcp_lease_table",
+    )
     stdin: TextIO
     stdout: TextIO
     stderr: TextIO
@@ -477,12 +585,7 @@ def main() -> int:
         except KeyError:
             logger.critical("No such user: {}".format(constants.AUTH_DHCP_USER))
             return os.EX_NOUSER
-        try:
-            group = grp.getgrgid(passwd.pw_gid)
-        except KeyError:
-            logger.critical("No such group: {:d}".format(passwd.pw_gid))
-            return os.EX_NOUSER
-        drop_privileges(passwd, group)
+        drop_privileges(passwd)
     parser = create_parser(standalone=True)
     args = parser.parse_args()
     setup_cli_logging(parser.prog, args)
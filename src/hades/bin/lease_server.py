@@ -80,12 +80,15 @@ def main() -> int:
             "More than one (%d) socket passed via socket activation", len(fds),
         )
         return os.EX_USAGE
+    # The server handles one request at a time, so a single pooled connection
+    # that is kept open across requests suffices
     engine = db.create_engine(
-        config, pool_size=1, max_overflow=2, pool_pre_ping=True,
+        config, pool_size=1, max_overflow=0, pool_pre_ping=True,
         pool_reset_on_return='rollback',
     )
     try:
-        engine.connect()
+        # Establish the pooled connection before accepting requests
+        engine.connect().close()
     except DBAPIError as e:
         logger.critical("Could not connect to database", exc_info=e)
         return os.EX_TEMPFAIL
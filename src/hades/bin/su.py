@@ -1,4 +1,3 @@
-import grp
 import logging
 import os
 import pwd
@@ -19,13 +18,12 @@ def main() -> int:
     setup_cli_logging(parser.prog, args)
     try:
         passwd = pwd.getpwnam(args.user)
-        group = grp.getgrgid(passwd.pw_gid)
     except KeyError:
-        logger.critical("No such user or group")
+        logger.critical("No such user")
         return os.EX_NOUSER
     filename = args.command
     try:
-        drop_privileges(passwd, group)
+        drop_privileges(passwd)
     except PermissionError:
         logging.exception("Can't drop privileges")
         return os.EX_NOPERM
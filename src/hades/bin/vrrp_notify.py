@@ -3,14 +3,18 @@
 
 Invoked by keepalived, if the state of VRRP instances changes.
 """
+import contextlib
+import fcntl
 import logging
 import os
+import pathlib
 import sys
 import textwrap
 import typing as t
 
 import kombu
 
+from hades import constants
 from hades.agent import create_app
 from hades.common.cli import ArgumentParser, common_parser, setup_cli_logging
 from hades.common.exc import handles_setup_errors
@@ -38,6 +42,30 @@ INSTANCES: t.Dict[str, t.Type[Option]] = {
     "hades-root": HADES_CELERY_ROUTING_KEY_MASTERS_SITE_ROOT,
     "hades-unauth": HADES_CELERY_ROUTING_KEY_MASTERS_SITE_UNAUTH,
 }
+#: Directory, in which the current state of each VRRP instance of this node is
+#: recorded
+STATE_DIRECTORY = pathlib.Path(constants.pkgrunstatedir) / "vrrp"
+
+
+def record_state(name: str, state: str) -> t.Set[str]:
+    """Record the state of a VRRP instance of this node.
+
+    Must be called with :data:`STATE_DIRECTORY` locked.
+
+    :param name: The name of the instance
+    :param state: The state the instance is transitioning to
+    :return: The names of the other instances of this node that are master
+    """
+    (STATE_DIRECTORY / name).write_text(state)
+    masters: t.Set[str] = set()
+    for other in INSTANCES.keys() - {name}:
+        try:
+            other_state = (STATE_DIRECTORY / other).read_text()
+        except FileNotFoundError:
+            continue
+        if other_state == "MASTER":
+            masters.add(other)
+    return masters
 
 
 def update_bindings(config: Config, name: str, state: str) -> None:
@@ -52,49 +80,81 @@ def update_bindings(config: Config, name: str, state: str) -> None:
         config[HADES_CELERY_NOTIFY_EXCHANGE_TYPE],
     )
     instance_key = config[INSTANCES[name]]
-    bindings = {
-        rpc_exchange: {instance_key},
-        notify_exchange: {
-            config[HADES_CELERY_ROUTING_KEY_MASTERS_ALL],
-            config[HADES_CELERY_ROUTING_KEY_MASTERS_SITE],
-            instance_key,
-        },
-    }
-    with app.connection(connect_timeout=1) as connection:
+    # The bindings of the routing key of the instance itself
+    instance_bindings = [
+        (rpc_exchange, instance_key),
+        (notify_exchange, instance_key),
+    ]
+    # The bindings, that are shared by all instances of the node. They must
+    # be kept as long as any instance of the node is master, because the
+    # instances fail over independently.
+    shared_bindings = [
+        (notify_exchange, config[HADES_CELERY_ROUTING_KEY_MASTERS_ALL]),
+        (notify_exchange, config[HADES_CELERY_ROUTING_KEY_MASTERS_SITE]),
+    ]
+    # Serialize the transitions of the instances of this node, so that the
+    # shared bindings are not removed, while another instance becomes master.
+    directory_fd = os.open(str(STATE_DIRECTORY), os.O_RDONLY | os.O_DIRECTORY
+                           | os.O_CLOEXEC)
+    with contextlib.ExitStack() as stack:
+        stack.callback(os.close, directory_fd)
+        fcntl.flock(directory_fd, fcntl.LOCK_EX)
+        masters = record_state(name, state)
+        changed_bindings = list(instance_bindings)
+        if state == "MASTER" or not masters:
+            changed_bindings.extend(shared_bindings)
+        else:
+            logger.info("Keeping shared bindings of master instances %s",
+                        ", ".join(sorted(masters)))
+        # Bound every socket operation, so that a broker that vanishes in the
+        # middle of a transition makes the script fail instead of blocking
+        # keepalived until the kernel gives up on the TCP connection.
+        connection = stack.enter_context(app.connection(
+            connect_timeout=1,
+            transport_options={"read_timeout": 1, "write_timeout": 1},
+        ))
         connection.ensure_connection(max_retries=0, timeout=1)
         queue = app.amqp.queues[queue_name]
+        # The declarations are idempotent, therefore they are sent without
+        # waiting for the broker to confirm them. If one of them fails, the
+        # broker closes the channel and the next method, that waits for a
+        # reply, raises the error.
         bound_queue = queue.bind(connection.default_channel)
-        bound_queue.declare()
-        if state == 'MASTER':
-            for exchange, keys in bindings.items():
-                bound_exchange = exchange.bind(connection.default_channel)
-                bound_exchange.declare()
-                for key in keys:
-                    logger.info(
-                        "Binding node queue %s to exchange %s "
-                        "with routing key %s",
-                        queue_name,
-                        exchange.name,
-                        key,
-                    )
-                    bound_queue.bind_to(
-                        exchange=bound_exchange, routing_key=key
-                    )
+        bound_queue.declare(nowait=True)
+        bound_exchanges: t.Dict[str, kombu.Exchange] = {}
+        for exchange in (rpc_exchange, notify_exchange):
+            bound_exchange = exchange.bind(connection.default_channel)
+            bound_exchange.declare(nowait=True)
+            bound_exchanges[exchange.name] = bound_exchange
+        if state == "MASTER":
+            # Likewise, only wait for the confirmation of the last binding
+            last = len(changed_bindings) - 1
+            for i, (exchange, key) in enumerate(changed_bindings):
+                logger.info(
+                    "Binding node queue %s to exchange %s "
+                    "with routing key %s",
+                    queue_name,
+                    exchange.name,
+                    key,
+                )
+                bound_queue.bind_to(
+                    exchange=bound_exchanges[exchange.name],
+                    routing_key=key,
+                    nowait=i < last,
+                )
         else:
-            for exchange, keys in bindings.items():
-                bound_exchange = exchange.bind(connection.default_channel)
-                bound_exchange.declare()
-                for key in keys:
-                    logger.info(
-                        "Unbinding node queue %s from exchange %s "
-                        "with routing key %s",
-                        queue_name,
-                        exchange.name,
-                        key,
-                    )
-                    bound_queue.unbind_from(
-                        exchange=rpc_exchange, routing_key=key
-                    )
+            for exchange, key in changed_bindings:
+                logger.info(
+                    "Unbinding node queue %s from exchange %s "
+                    "with routing key %s",
+                    queue_name,
+                    exchange.name,
+                    key,
+                )
+                bound_queue.unbind_from(
+                    exchange=bound_exchanges[exchange.name],
+                    routing_key=key,
+                )
 
 
 def create_parser() -> ArgumentParser:
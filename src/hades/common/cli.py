@@ -195,7 +195,8 @@ def setup_cli_logging(program, args):
 def reset_cli_logging():
     """Reset root logger configuration"""
     root = logging.root
-    for h in root.handlers:
+    # Iterate over copies, as the handlers and filters are removed in the loops
+    for h in list(root.handlers):
         try:
             h.acquire()
             h.flush()
@@ -205,5 +206,5 @@ def reset_cli_logging():
         finally:
             h.release()
         root.removeHandler(h)
-    for f in root.filters:
+    for f in list(root.filters):
         root.removeFilter(f)
@@ -6,6 +6,7 @@ This module contains
 - structures related to the former, like :class:`TypeDecorators <sqlalchemy:sqlalchemy.types.TypeDecorator>`
 - functions interacting with the database (both for reading and manipulating)
 """
+import functools
 import logging
 import operator
 from dataclasses import dataclass
@@ -27,13 +28,15 @@ import sqlalchemy.exc
 from sqlalchemy import (
     BigInteger, CheckConstraint, Column, DateTime, Integer, LargeBinary,
     MetaData, PrimaryKeyConstraint, String, Table, Text, TypeDecorator,
-    UniqueConstraint, and_, column, create_engine as sqa_create_engine, func,
-    null, or_, select, table, literal,
+    UniqueConstraint, and_, bindparam, case, column,
+    create_engine as sqa_create_engine, func, null, or_, select, table, literal,
 )
 from sqlalchemy.dialects.postgresql import ARRAY, INET, MACADDR
 from sqlalchemy.engine.base import Connection
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql import expression
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.util import LRUCache
 
 from hades.config import Config, get_config
 from hades.common.exc import UsageError
@@ -41,6 +44,10 @@ from hades.common.exc import UsageError
 logger = logging.getLogger(__name__)
 metadata = MetaData()
 
+#: Cache of the compiled forms of the lookup statements, which are executed
+#: for every RPC call and portal request
+compiled_cache = LRUCache(64)
+
 Groups = Tuple[str, ...]
 Attributes = Tuple[Tuple[str, str], ...]
 DatetimeRange = Tuple[Optional[datetime], Optional[datetime]]
@@ -86,7 +93,14 @@ class MACAddress(TypeDecorator):
     def process_result_value(self, value, dialect):
         if value is None:
             return None
-        return netaddr.EUI(value, dialect=netaddr.mac_pgsql)
+        # PostgreSQL always outputs macaddr values as xx:xx:xx:xx:xx:xx, so
+        # the integer value can be passed to netaddr directly instead of
+        # letting it try every known format on the string
+        return netaddr.EUI(
+            int(value.replace(":", ""), 16),
+            version=48,
+            dialect=netaddr.mac_pgsql,
+        )
 
 
 def eui_as_unix(mac: netaddr.EUI) -> netaddr.EUI:
@@ -575,28 +589,29 @@ def diff_tables(
     on_clause = and_(*(getattr(master.c, column_name) ==
                        getattr(copy.c, column_name)
                        for column_name in unique_column_names))
-    added = connection.execute(
-        select(result_columns)
-        .select_from(master.outerjoin(copy, on_clause))
-        .where(or_(*(getattr(copy.c, column_name).is_(null())
-                     for column_name in unique_column_names)))
-    ).fetchall()
-    deleted = connection.execute(
-        select(result_columns)
-        .select_from(copy.outerjoin(master, on_clause))
-        .where(or_(*(getattr(master.c, column_name).is_(null())
-                     for column_name in unique_column_names)))
-    ).fetchall()
-    modified = connection.execute(
-        select(result_columns)
-        .select_from(master.join(copy, on_clause))
-        .where(or_(*(getattr(master.c, column_name) !=
-                     getattr(copy.c, column_name)
-                     for column_name in other_column_names)))
-    ).fetchall() if other_column_names else []
+    # Classify all rows in a single pass over both tables
+    added_clause = or_(*(getattr(copy.c, column_name).is_(null())
+                         for column_name in unique_column_names))
+    deleted_clause = or_(*(getattr(master.c, column_name).is_(null())
+                           for column_name in unique_column_names))
+    whens = [(added_clause, literal("A")), (deleted_clause, literal("D"))]
+    if other_column_names:
+        modified_clause = or_(*(getattr(master.c, column_name) !=
+                                getattr(copy.c, column_name)
+                                for column_name in other_column_names))
+        whens.append((modified_clause, literal("M")))
+    query = (
+        select([case(whens), *result_columns])
+        .select_from(master.outerjoin(copy, on_clause, full=True))
+        .where(or_(*(clause for clause, _ in whens)))
+    )
+    diff: ObjectsDiff[Tuple] = ObjectsDiff([], [], [])
+    results = {"A": diff.added, "D": diff.deleted, "M": diff.modified}
+    for state, *values in connection.execute(query):
+        results[state].append(tuple(values))
     logger.debug('Diff found %d added, %d deleted, and %d modified records',
-                 len(added), len(deleted), len(modified))
-    return ObjectsDiff(added, deleted, modified)
+                 len(diff.added), len(diff.deleted), len(diff.modified))
+    return diff
 
 
 def refresh_materialized_view(connection: Connection, view: Table):
@@ -657,6 +672,17 @@ def delete_old_auth_attempts(connection: Connection, interval: timedelta):
     )))
 
 
+@functools.lru_cache(maxsize=None)
+def groups_query() -> Select:
+    """Build a query for the groups of the MAC address bound to the ``mac``
+    parameter."""
+    return select([radusergroup.c.NASIPAddress,
+                   radusergroup.c.NASPortId,
+                   radusergroup.c.GroupName]).where(
+        radusergroup.c.UserName == bindparam("mac")
+    )
+
+
 def get_groups(
     connection: Connection,
     mac: netaddr.EUI,
@@ -670,10 +696,9 @@ def get_groups(
         tuples
     """
     logger.debug('Getting groups of MAC "%s"', mac)
-    results = connection.execute(select([radusergroup.c.NASIPAddress,
-                                         radusergroup.c.NASPortId,
-                                         radusergroup.c.GroupName])
-                                 .where(radusergroup.c.UserName == mac))
+    results = connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(groups_query(), mac=mac)
     return iter(results)
 
 
@@ -741,6 +766,25 @@ def get_all_nas_clients(
     return iter(result)
 
 
+@functools.lru_cache(maxsize=None)
+def sessions_of_mac_query(limited: bool) -> Select:
+    """Build a query for the accounting sessions of the MAC address bound to
+    the ``mac`` parameter.
+
+    :param limited: Limit the number of records to the ``limit`` parameter
+    """
+    query = (
+        select([radacct.c.NASIPAddress, radacct.c.NASPortId,
+                radacct.c.AcctStartTime,
+                radacct.c.AcctStopTime])
+        .where(and_(radacct.c.UserName == bindparam("mac")))
+        .order_by(radacct.c.AcctStartTime.desc())
+    )
+    if limited:
+        query = query.limit(bindparam("limit", type_=Integer))
+    return query
+
+
 def get_sessions_of_mac(
     connection: Connection,
     mac: netaddr.EUI,
@@ -760,18 +804,31 @@ def get_sessions_of_mac(
         Session-Start-Time descending
     """
     logger.debug('Getting all sessions for MAC "%s"', mac)
-    query = (
-        select([radacct.c.NASIPAddress, radacct.c.NASPortId,
-                radacct.c.AcctStartTime,
-                radacct.c.AcctStopTime])
-        .where(and_(radacct.c.UserName == mac))
-        .order_by(radacct.c.AcctStartTime.desc())
-    )
+    query = sessions_of_mac_query(limit is not None)
     if when is not None:
         query.where(radacct.c.AcctStartTime.op('<@')(func.tstzrange(*when)))
-    if limit is not None:
-        query = query.limit(limit)
-    return iter(connection.execute(query))
+    return iter(connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(query, mac=mac, limit=limit))
+
+
+@functools.lru_cache(maxsize=None)
+def auth_attempts_of_mac_query(limited: bool) -> Select:
+    """Build a query for the auth attempts of the MAC address bound to the
+    ``mac`` parameter.
+
+    :param limited: Limit the number of records to the ``limit`` parameter
+    """
+    query = (
+        select([radpostauth.c.NASIPAddress, radpostauth.c.NASPortId,
+                radpostauth.c.PacketType, radpostauth.c.Groups,
+                radpostauth.c.Reply, radpostauth.c.AuthDate])
+        .where(and_(radpostauth.c.UserName == bindparam("mac")))
+        .order_by(radpostauth.c.AuthDate.desc())
+    )
+    if limited:
+        query = query.limit(bindparam("limit", type_=Integer))
+    return query
 
 
 def get_auth_attempts_of_mac(
@@ -792,18 +849,34 @@ def get_auth_attempts_of_mac(
         Groups, Reply, Auth-Date)-tuples ordered by Auth-Date descending
     """
     logger.debug('Getting all auth attempts of MAC %s', mac)
+    query = auth_attempts_of_mac_query(limit is not None)
+    if when is not None:
+        query.where(radpostauth.c.AuthDate.op('<@')(func.tstzrange(*when)))
+    return iter(connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(query, mac=mac, limit=limit))
+
+
+@functools.lru_cache(maxsize=None)
+def auth_attempts_at_port_query(limited: bool) -> Select:
+    """Build a query for the auth attempts at the port of an NAS bound to the
+    ``nas_ip_address`` and ``nas_port_id`` parameters.
+
+    :param limited: Limit the number of records to the ``limit`` parameter
+    """
     query = (
-        select([radpostauth.c.NASIPAddress, radpostauth.c.NASPortId,
-                radpostauth.c.PacketType, radpostauth.c.Groups,
-                radpostauth.c.Reply, radpostauth.c.AuthDate])
-        .where(and_(radpostauth.c.UserName == mac))
+        select([radpostauth.c.UserName, radpostauth.c.PacketType,
+                radpostauth.c.Groups, radpostauth.c.Reply,
+                radpostauth.c.AuthDate])
+        .where(and_(
+            radpostauth.c.NASIPAddress == bindparam("nas_ip_address"),
+            radpostauth.c.NASPortId == bindparam("nas_port_id"),
+        ))
         .order_by(radpostauth.c.AuthDate.desc())
     )
-    if when is not None:
-        query.where(radpostauth.c.AuthDate.op('<@')(func.tstzrange(*when)))
-    if limit is not None:
-        query = query.limit(limit)
-    return iter(connection.execute(query))
+    if limited:
+        query = query.limit(bindparam("limit", type_=Integer))
+    return query
 
 
 def get_auth_attempts_at_port(
@@ -827,19 +900,17 @@ def get_auth_attempts_at_port(
     """
     logger.debug('Getting all auth attempts at port %2$s of %1$s',
                  nas_ip_address, nas_port_id)
-    query = (
-        select([radpostauth.c.UserName, radpostauth.c.PacketType,
-                radpostauth.c.Groups, radpostauth.c.Reply,
-                radpostauth.c.AuthDate])
-        .where(and_(radpostauth.c.NASIPAddress == nas_ip_address,
-                    radpostauth.c.NASPortId == nas_port_id))
-        .order_by(radpostauth.c.AuthDate.desc())
-    )
+    query = auth_attempts_at_port_query(limit is not None)
     if when is not None:
         query.where(radpostauth.c.AuthDate.op('<@')(func.tstzrange(*when)))
-    if limit is not None:
-        query = query.limit(limit)
-    return iter(connection.execute(query))
+    return iter(connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(
+        query,
+        nas_ip_address=nas_ip_address,
+        nas_port_id=nas_port_id,
+        limit=limit,
+    ))
 
 
 def get_all_alternative_dns_ips(
@@ -900,6 +971,20 @@ def get_all_dhcp_leases(
     return iter(connection.execute(query))
 
 
+@functools.lru_cache(maxsize=None)
+def dhcp_lease_of_ip_query(dhcp_lease_table: Table) -> Select:
+    """Build a query for the lease of the IP address bound to the ``ip``
+    parameter."""
+    return select(
+        [
+            dhcp_lease_table.c.ExpiresAt,
+            dhcp_lease_table.c.MAC,
+            dhcp_lease_table.c.Hostname,
+            dhcp_lease_table.c.ClientID,
+        ]
+    ).where(dhcp_lease_table.c.IPAddress == bindparam("ip"))
+
+
 def get_dhcp_lease_of_ip(
     dhcp_lease_table: Table,
     connection: Connection,
@@ -913,15 +998,26 @@ def get_dhcp_lease_of_ip(
     :param ip: IP address
     :return: An (Expiry-Time, MAC, Hostname, Client-ID)-tuple or None
     """
-    query = select(
+    query = dhcp_lease_of_ip_query(dhcp_lease_table)
+    return connection.execution_options(  # type: ignore
+        compiled_cache=compiled_cache
+    ).execute(query, ip=ip).first()
+
+
+@functools.lru_cache(maxsize=None)
+def dhcp_leases_of_mac_query(dhcp_lease_table: Table) -> Select:
+    """Build a query for the leases of the MAC address bound to the ``mac``
+    parameter."""
+    return select(
         [
             dhcp_lease_table.c.ExpiresAt,
-            dhcp_lease_table.c.MAC,
+            dhcp_lease_table.c.IPAddress,
             dhcp_lease_table.c.Hostname,
             dhcp_lease_table.c.ClientID,
         ]
-    ).where(dhcp_lease_table.c.IPAddress == ip)
-    return connection.execute(query).first()  # type: ignore
+    ).where(
+        dhcp_lease_table.c.MAC == bindparam("mac")
+    ).order_by(dhcp_lease_table.c.ExpiresAt.desc())
 
 
 def get_dhcp_leases_of_mac(
@@ -938,15 +1034,10 @@ def get_dhcp_leases_of_mac(
     :return: An iterator of (Expiry-Time, IP-Address, Hostname,
         Client-ID)-tuples ordered by Expiry-Time descending
     """
-    query = select(
-        [
-            dhcp_lease_table.c.ExpiresAt,
-            dhcp_lease_table.c.IPAddress,
-            dhcp_lease_table.c.Hostname,
-            dhcp_lease_table.c.ClientID,
-        ]
-    ).where(dhcp_lease_table.c.MAC == mac).order_by(dhcp_lease_table.c.ExpiresAt.desc())
-    return iter(connection.execute(query))
+    query = dhcp_leases_of_mac_query(dhcp_lease_table)
+    return iter(connection.execution_options(
+        compiled_cache=compiled_cache
+    ).execute(query, mac=mac))
 
 
 def get_all_auth_dhcp_leases(
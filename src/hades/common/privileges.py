@@ -7,11 +7,11 @@ import pwd
 logger = logging.getLogger(__name__)
 
 
-def drop_privileges(passwd, group):
-    """Drop privileges completely"""
+def drop_privileges(passwd: pwd.struct_passwd):
+    """Drop privileges completely to the user and its primary group"""
     logger.debug("Dropping privileges to user %s", passwd.pw_name)
-    os.setgid(group.gr_gid)
-    os.initgroups(passwd.pw_name, group.gr_gid)
+    os.setgid(passwd.pw_gid)
+    os.initgroups(passwd.pw_name, passwd.pw_gid)
     os.setuid(passwd.pw_uid)
 
 
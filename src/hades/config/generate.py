@@ -345,6 +345,8 @@ class ConfigGenerator:
     DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S%z"
     """Format string for producing RFC3339-compatible datetime strings"""
     TEMPLATE_SUFFIX = ".j2"
+    WRITE_BUFFER_SIZE = 64 * 1024
+    """Buffer size for writing rendered templates to files"""
 
     def __init__(self, template_dirs: Union[PathArg, Iterable[PathArg]],
                  config, mode: int = 0o0750,
@@ -532,21 +534,34 @@ class ConfigGenerator:
                                    destination: pathlib.Path):
         destination = pathlib.Path(destination)
         # Safely create file:
-        # 1. Create with O_CREAT | O_EXCL
+        # 1. Create a temporary file next to the destination with
+        #    O_CREAT | O_EXCL
         # 2. Unlink if fails
         # 3. Try again
+        # 4. Rename the temporary file to the destination once the template
+        #    has been rendered completely, so that readers never see a
+        #    partially written file
         logger.info("Creating %s from template %s", destination, source)
+        temporary = destination.with_name(".{}.tmp".format(destination.name))
         try:
-            fd = self._create_file(destination)
+            fd = self._create_file(temporary)
         except FileExistsError:
-            destination.unlink()
-            fd = self._create_file(destination)
-        self._setgroup(destination)
-        with os.fdopen(fd, mode='w', encoding='utf-8') as writer:
-            self._generate_template_to_writer(
-                base, source, writer,
-                destination_dir=destination.parent,
-                destination=destination)
+            temporary.unlink()
+            fd = self._create_file(temporary)
+        try:
+            # Let the file object own the descriptor first, so that it is
+            # closed if anything below fails
+            with os.fdopen(fd, mode='w', encoding='utf-8',
+                           buffering=self.WRITE_BUFFER_SIZE) as writer:
+                self._setgroup(temporary)
+                self._generate_template_to_writer(
+                    base, source, writer,
+                    destination_dir=destination.parent,
+                    destination=destination)
+            os.replace(str(temporary), str(destination))
+        except BaseException:
+            temporary.unlink()
+            raise
 
     def _generate_template_to_stdout(self, base: pathlib.Path,
                                      source: pathlib.Path):
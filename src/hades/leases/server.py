@@ -8,6 +8,7 @@ import io
 import logging
 import mmap
 import os
+import selectors
 import signal
 import socket
 import socketserver
@@ -26,7 +27,12 @@ from typing import Dict, Generator, List, Literal, Optional, Sequence, Tuple, Ty
 from sqlalchemy import Table
 from sqlalchemy.engine import Engine
 
-from hades.bin.dhcp_script import Context, create_parser, dispatch_commands
+from hades.bin.dhcp_script import (
+    Context,
+    create_parser,
+    dispatch_commands,
+    parse_lease_command,
+)
 from hades.common.signals import install_handler
 
 logger = logging.getLogger(__name__)
@@ -267,6 +273,16 @@ class Server(socketserver.UnixStreamServer):
             server_address, self._request_handler, bind_and_activate=False,
         )
         self.socket = sock
+        self._shutdown_requested = False
+        self._is_shut_down = threading.Event()
+        # Wakes up the serve_forever loop on signals and shutdown requests.
+        # The lock guards writing to the pipe from shutdown against closing it
+        # in server_close, so that a descriptor, that has been closed and
+        # reused in the meantime, is never written to.
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe2(
+            os.O_NONBLOCK | os.O_CLOEXEC
+        )
         # Leave one byte extra for trailing zero byte
         # TODO: With Python 3.8 a memfd can be opened and mapped twice:
         # writable and readonly
@@ -553,25 +569,79 @@ class Server(socketserver.UnixStreamServer):
 
     def _handle_shutdown_signal(self, signo: int, _frame: typing.Any) -> None:
         logger.critical("Received signal %d. Shutting down.", signo)
-        # shutdown blocks until the server is stopped, therefore we must use a
-        # separate thread, otherwise there will be deadlock
-        threading.Thread(name='shutdown', target=self.shutdown).start()
+        self._shutdown_requested = True
+
+    def serve_forever(self, poll_interval: Optional[float] = None):
+        """Handle requests until a shutdown signal is received or
+        :meth:`shutdown` is called.
+
+        Unlike :meth:`socketserver.BaseServer.serve_forever`, the loop does not
+        wake up periodically to check for a shutdown request by default.
+        Instead, signals wake up the selector through
+        :func:`signal.set_wakeup_fd`.
 
-    def serve_forever(self, poll_interval: float = 0.5):
+        Must be called from the main thread.
+
+        :param poll_interval: Optional timeout in seconds for waiting for
+            requests
+        """
         logger.info("Starting server loop")
-        with install_handler(
-            (signal.SIGHUP, signal.SIGINT, signal.SIGTERM),
-            self._handle_shutdown_signal
-        ):
-            super().serve_forever(poll_interval)
+        self._is_shut_down.clear()
+        with contextlib.ExitStack() as stack:
+            stack.callback(self._is_shut_down.set)
+            stack.callback(setattr, self, "_shutdown_requested", False)
+            stack.enter_context(install_handler(
+                (signal.SIGHUP, signal.SIGINT, signal.SIGTERM),
+                self._handle_shutdown_signal
+            ))
+            stack.callback(signal.set_wakeup_fd,
+                           signal.set_wakeup_fd(self._wakeup_write))
+            selector = stack.enter_context(selectors.DefaultSelector())
+            selector.register(self, selectors.EVENT_READ)
+            selector.register(self._wakeup_read, selectors.EVENT_READ)
+            while not self._shutdown_requested:
+                for key, _events in selector.select(poll_interval):
+                    if key.fileobj is self:
+                        self.handle_request()
+                    else:
+                        # Drain the signal numbers and shutdown wakeups, the
+                        # signal handler has already been called
+                        with contextlib.suppress(BlockingIOError):
+                            os.read(self._wakeup_read, 512)
+                self.service_actions()
+
+    def shutdown(self) -> None:
+        """Stop the :meth:`serve_forever` loop and wait until it has stopped.
+
+        Like :meth:`socketserver.BaseServer.shutdown`, this must be called
+        from another thread than :meth:`serve_forever`, otherwise it will
+        deadlock.
+        """
+        self._shutdown_requested = True
+        with self._wakeup_lock:
+            if self._wakeup_write != -1:
+                # If the pipe is full, the loop will wake up anyway
+                with contextlib.suppress(BlockingIOError):
+                    os.write(self._wakeup_write, b"\0")
+        self._is_shut_down.wait()
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self._wakeup_lock:
+            if self._wakeup_read != -1:
+                os.close(self._wakeup_read)
+                os.close(self._wakeup_write)
+                self._wakeup_read = self._wakeup_write = -1
 
     def _process(
             self,
             stdin: TextIO, stdout: TextIO, stderr: TextIO,
             args: Sequence[bytes], env: Dict[bytes, bytes]
     ) -> int:
-        decoded_args = [decode(a) for a in args]
-        parsed_args = self.parser.parse_args(decoded_args[1:])
+        decoded_args = [decode(a) for a in args[1:]]
+        parsed_args = parse_lease_command(decoded_args)
+        if parsed_args is None:
+            parsed_args = self.parser.parse_args(decoded_args)
         return dispatch_commands(
             args=parsed_args,
             context=Context(
@@ -6,6 +6,7 @@ import mmap
 import os
 import socket
 import struct
+import threading
 import typing as t
 from io import FileIO
 
@@ -325,3 +326,16 @@ def test_zip_left():
         ("b", "b"),
         ("c", "c"),
     ]
+
+
+def test_shutdown(tmp_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(tmp_path / "server.sock"))
+    sock.listen()
+    server = Server(sock, None, None)
+    thread = threading.Thread(target=server.shutdown)
+    with server:
+        thread.start()
+        server.serve_forever()
+        thread.join(timeout=5)
+    assert not thread.is_alive()
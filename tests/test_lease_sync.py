@@ -1,14 +1,18 @@
+from argparse import Namespace
+from datetime import datetime, timezone
 from unittest.mock import MagicMock
 import sys
 
-import netaddr
 import pytest
 from netaddr import EUI, IPAddress
+from sqlalchemy.dialects import postgresql
 
 from hades.bin.dhcp_script import (
-    perform_lease_update,
+    create_parser,
+    generate_leasefile_lines,
     obtain_lease_info,
-    LeaseArguments,
+    parse_lease_command,
+    upsert_lease,
     Context,
 )
 from hades.common.db import auth_dhcp_lease
@@ -54,7 +58,7 @@ def test_obtain_lease_info():
     }.items()}
 
     info = obtain_lease_info(
-        args=LeaseArguments(
+        args=Namespace(
             mac=EUI('00:de:ad:be:ef:00'),
             ip=IPAddress('141.76.121.2'),
             hostname=None,
@@ -81,27 +85,62 @@ def test_obtain_lease_info():
 def test_add_lease():
     pass
 
+
+def test_generate_leasefile_lines():
+    expires_at = datetime(2017, 10, 25, 22, 10, 13, tzinfo=timezone.utc)
+    leases = [
+        (expires_at, EUI('00-DE-AD-BE-EF-00'), IPAddress('141.76.121.2'),
+         'host', b'\x01\x50\x7b\x9d\x87\x76\x4b'),
+        (expires_at, EUI('00-DE-AD-BE-EF-01'), IPAddress('141.76.121.3'),
+         None, None),
+    ]
+    assert list(generate_leasefile_lines(leases)) == [
+        b"1508969413 00:de:ad:be:ef:00 141.76.121.2 host 01:50:7b:9d:87:76:4b\n",
+        b"1508969413 00:de:ad:be:ef:01 141.76.121.3 * *\n",
+    ]
+
+
 @pytest.fixture
 def conn_mock():
-    conn = MagicMock()
-    result_mock = MagicMock()
-    result_mock.rowcount = 1
-    conn.execute.return_value = result_mock
-    return conn
+    return MagicMock()
 
 
-def test_trivial_lease_update_does_nothing(conn_mock):
+def test_upsert_lease_uses_single_statement(conn_mock):
     values = {
-        # TODO find a more representative set of values
-        'DNSMASQ_CLIENT_ID': '01:50:7b:9d:87:76:4b',
+        'IPAddress': IPAddress('141.30.1.1'),
+        'MAC': EUI('00:de:ad:be:ef:00'),
+        'ClientID': b'\x01\x50\x7b\x9d\x87\x76\x4b',
     }
-    result = perform_lease_update(
-        conn_mock,
-        dhcp_lease_table=auth_dhcp_lease,
-        ip=netaddr.IPAddress('141.30.1.1'),
-        mac=netaddr.EUI('00:de:ad:be:ef:00'),
-        old=values,
-        new=values,
-    )
-    assert conn_mock.execute.mock_calls == []
-    assert result is None
+    upsert_lease(conn_mock, auth_dhcp_lease, values)
+    [call] = conn_mock.execution_options.return_value.execute.call_args_list
+    query, params = call.args
+    assert params == values
+    sql = str(query.compile(dialect=postgresql.dialect(), column_keys=params))
+    assert 'ON CONFLICT ("IPAddress") DO UPDATE' in sql
+    assert '"MAC" = excluded."MAC"' in sql
+    assert '"IPAddress" = excluded' not in sql
+    assert '"UpdatedAt" = excluded."UpdatedAt"' in sql
+
+
+@pytest.mark.parametrize("args", [
+    ["init"],
+    ["add", "00:de:ad:be:ef:00", "141.76.121.2"],
+    ["old", "00:de:ad:be:ef:00", "141.76.121.2", "host"],
+    ["del", "00-DE-AD-BE-EF-00", "141.76.121.2"],
+])
+def test_parse_lease_command_matches_parser(args):
+    parsed = parse_lease_command(args)
+    assert parsed is not None
+    assert parsed == create_parser(standalone=False).parse_args(args)
+
+
+@pytest.mark.parametrize("args", [
+    [],
+    ["tftp", "1024", "141.76.121.2", "/boot.img"],
+    ["add", "00:de:ad:be:ef:00"],
+    ["add", "no-mac", "141.76.121.2"],
+    ["add", "00:de:ad:be:ef:00", "141.76.121.2", "host", "extra"],
+    ["-v", "init"],
+])
+def test_parse_lease_command_falls_back(args):
+    assert parse_lease_command(args) is None
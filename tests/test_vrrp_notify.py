@@ -0,0 +1,91 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from hades.bin import vrrp_notify
+from hades.bin.vrrp_notify import update_bindings
+from hades.config.options import (
+    HADES_CELERY_NOTIFY_EXCHANGE,
+    HADES_CELERY_ROUTING_KEY_MASTERS_ALL,
+    HADES_CELERY_ROUTING_KEY_MASTERS_SITE,
+    HADES_CELERY_ROUTING_KEY_MASTERS_SITE_AUTH,
+    HADES_CELERY_RPC_EXCHANGE,
+)
+
+
+@pytest.fixture
+def app(monkeypatch) -> MagicMock:
+    app = MagicMock()
+    monkeypatch.setattr(vrrp_notify, "create_app", lambda config: app)
+    return app
+
+
+@pytest.fixture
+def config() -> MagicMock:
+    config = MagicMock()
+    config.__getitem__.side_effect = lambda option: option.__name__
+    return config
+
+
+def bindings(calls):
+    return {
+        (call.kwargs["exchange"].name, call.kwargs["routing_key"])
+        for call in calls
+    }
+
+
+@pytest.fixture(autouse=True)
+def state_directory(monkeypatch, tmp_path):
+    monkeypatch.setattr(vrrp_notify, "STATE_DIRECTORY", tmp_path)
+    return tmp_path
+
+
+INSTANCE_BINDINGS = {
+    (
+        HADES_CELERY_RPC_EXCHANGE.__name__,
+        HADES_CELERY_ROUTING_KEY_MASTERS_SITE_AUTH.__name__,
+    ),
+    (
+        HADES_CELERY_NOTIFY_EXCHANGE.__name__,
+        HADES_CELERY_ROUTING_KEY_MASTERS_SITE_AUTH.__name__,
+    ),
+}
+SHARED_BINDINGS = {
+    (
+        HADES_CELERY_NOTIFY_EXCHANGE.__name__,
+        HADES_CELERY_ROUTING_KEY_MASTERS_SITE.__name__,
+    ),
+    (
+        HADES_CELERY_NOTIFY_EXCHANGE.__name__,
+        HADES_CELERY_ROUTING_KEY_MASTERS_ALL.__name__,
+    ),
+}
+
+
+def test_update_bindings_master(app, config, state_directory):
+    update_bindings(config, "hades-auth", "MASTER")
+    queue = app.amqp.queues.__getitem__.return_value.bind.return_value
+    assert bindings(queue.bind_to.call_args_list) == (
+        INSTANCE_BINDINGS | SHARED_BINDINGS
+    )
+    queue.unbind_from.assert_not_called()
+    assert (state_directory / "hades-auth").read_text() == "MASTER"
+
+
+def test_update_bindings_backup(app, config, state_directory):
+    (state_directory / "hades-root").write_text("BACKUP")
+    update_bindings(config, "hades-auth", "BACKUP")
+    queue = app.amqp.queues.__getitem__.return_value.bind.return_value
+    assert bindings(queue.unbind_from.call_args_list) == (
+        INSTANCE_BINDINGS | SHARED_BINDINGS
+    )
+    queue.bind_to.assert_not_called()
+    assert (state_directory / "hades-auth").read_text() == "BACKUP"
+
+
+def test_update_bindings_backup_other_master(app, config, state_directory):
+    (state_directory / "hades-root").write_text("MASTER")
+    update_bindings(config, "hades-auth", "BACKUP")
+    queue = app.amqp.queues.__getitem__.return_value.bind.return_value
+    assert bindings(queue.unbind_from.call_args_list) == INSTANCE_BINDINGS
+    queue.bind_to.assert_not_called()